@@ -4,106 +4,245 @@ from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import StandardOptions
 from apache_beam.options.pipeline_options import GoogleCloudOptions
 from apache_beam.options.pipeline_options import WorkerOptions
+from apache_beam.options.pipeline_options import SetupOptions
+from apache_beam.options.pipeline_options import DebugOptions
 from apache_beam.io.gcp.internal.clients import bigquery
-from apache_beam.pvalue import AsList
+from apache_beam.io.gcp.bigquery_tools import FileFormat
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.pvalue import AsDict
+from typing import Any, Iterable, NamedTuple, Optional, Tuple
 import logging
-import json
+import os
+import orjson
+import zlib
 import argparse
 
 
-def process_artists(row, gender, area):
+class ArtistRow(NamedTuple):
+    id: int
+    artist_gid: str
+    artist_name: str
+    area: Optional[str]
+    gender: Optional[str]
+
+
+class ArtistCreditRow(NamedTuple):
+    id: int
+    artist_gid: str
+    artist_name: str
+    area: Optional[str]
+    gender: Optional[str]
+    artist_credit: int
+
+
+class RecordingRow(NamedTuple):
+    recording_name: str
+    length: Optional[int]
+    recording_gid: str
+    video: bool
+
+
+class JoinValue(NamedTuple):
+    artist_credit: Optional[ArtistCreditRow]
+    recording: Optional[RecordingRow]
+
+
+beam.coders.registry.register_coder(ArtistRow, beam.coders.RowCoder)
+beam.coders.registry.register_coder(ArtistCreditRow, beam.coders.RowCoder)
+beam.coders.registry.register_coder(RecordingRow, beam.coders.RowCoder)
+beam.coders.registry.register_coder(JoinValue, beam.coders.RowCoder)
+
+
+class ProcessArtists(beam.DoFn):
+    def __init__(self, gender_map, area_map):
+        """
+        :param gender_map: dictionary of gender id to name mappings
+        :param area_map: dictionary of area id to name mappings
+        """
+        super().__init__()
+        self._gender = gender_map
+        self._area = area_map
+
+    def process(self, element) -> Iterable[Tuple[int, ArtistRow]]:
+        """
+        Processes artist json elements, resolving gender and area ids to their names
+        :param element: Bytes json object from artist.json
+        :return: tuple in the form (id, ArtistRow)
+        """
+        row = orjson.loads(element)
+        yield (row['id'], ArtistRow(
+            id=row['id'],
+            artist_gid=row['gid'],
+            artist_name=row['name'],
+            area=self._area.get(row['area']),
+            gender=self._gender.get(row['gender']),
+        ))
+
+
+def process_gender_or_area(element) -> Tuple[int, str]:
     """
-    Processes artist PCollection with gender and area PCollections as side inputs
-    The function will
-    :param row: Dictionary element from beam.PCollection
-    :param gender: list of gender id and name mappings
-    :param area: list of area id and name mappings
-    :return: tuple in the form (id, row)
+    Utility function that processes text json from area.json or gender.json
+    :param element: Bytes json object that needs to be parsed
+    :return: set(id, name)
     """
-    reduced_row = {
-        'id': row['id'],
-        'artist_gid': row['gid'],
-        'artist_name': row['name'],
-        'area': row['area'],
-        'gender': row['gender'],
-    }
-    if reduced_row['gender']:
-        for g in gender:
-            if g['id'] == reduced_row['gender']:
-                reduced_row['gender'] = g['name']
-    for a in area:
-        if a['id'] == reduced_row['area']:
-            reduced_row['area'] = a['name']
-    return (reduced_row['id'], reduced_row)
+    row = orjson.loads(element)
+    return (row['id'], row['name'])
 
 
-def process_gender_or_area(element):
+def load_gender_or_area(file_pattern):
     """
-    Utility function that processes text json from area.json or gender.json
-    :param element: String json object that needs to be parsed
-    :return: {id: int, name: string}
+    Reads area.json or gender.json while the pipeline is being constructed. Both files are tiny, so the resulting
+    lookup is shipped with ProcessArtists instead of being read and broadcast as a side input on every worker
+    :param file_pattern: path of the json file to read
+    :return: dictionary of id to name mappings
     """
-    row = json.loads(element)
-    return {
-        'id': row['id'],
-        'name': row['name']
-    }
+    lookup = {}
+    with FileSystems.open(file_pattern) as f:
+        for line in f:
+            if line.strip():
+                key, name = process_gender_or_area(line)
+                lookup[key] = name
+    return lookup
 
 
-def process_artist_credit(element):
+def process_artist_credit(element) -> Tuple[int, int]:
     """
     This function is used to decode json elements from artist_credit_name.json.
-    :param element: json string element
-    :return: set(artist_id, dict). Dictionary has only columns of interest preserved from the original element
+    :param element: json bytes element
+    :return: set(artist_id, artist_credit)
     """
-    row = json.loads(element)
-    reduced_row = {
-        'artist_credit': row['artist_credit'],
-        'artist': row['artist']
-    }
-    return (reduced_row['artist'], reduced_row)
+    row = orjson.loads(element)
+    return (row['artist'], row['artist_credit'])
 
 
-def process_recording(element):
+def process_recording(element) -> Tuple[int, RecordingRow]:
     """
     This method processes json records in recording.json
-    :param element: Json string object
-    :return: set(artist_credit, dict). Dictionary has only columns of interest preserved from the original element
-    """
-    row = json.loads(element)
-    reduced_row = {
-        'recording_name': row['name'],
-        'length': row['length'],
-        'recording_gid': row['gid'],
-        'video': row['video'],
-        'artist_credit': row['artist_credit']
-    }
-    return (reduced_row['artist_credit'], reduced_row)
+    :param element: Json bytes object
+    :return: set(artist_credit, RecordingRow). Only columns of interest are preserved from the original element,
+    artist_credit itself is carried by the key
+    """
+    row = orjson.loads(element)
+    return (row['artist_credit'], RecordingRow(
+        recording_name=row['name'],
+        length=row['length'],
+        recording_gid=row['gid'],
+        video=row['video'],
+    ))
+
+
+class ReadJson(beam.PTransform):
+    """
+    Reads a newline delimited json file and parses every line straight into its projected form. Reading and
+    parsing are kept in a single fused step so only the reduced element outlives the raw line. Lines are kept as
+    bytes since orjson parses them without a utf-8 decode.
+    """
+    def __init__(self, file_pattern, process_fn, *args):
+        """
+        :param file_pattern: path of the json file to read
+        :param process_fn: function or DoFn that parses a json bytes line and returns the projected element
+        :param args: extra arguments or side inputs passed to process_fn after the line
+        """
+        super().__init__()
+        self._file_pattern = file_pattern
+        self._process_fn = process_fn
+        self._args = args
+
+    def expand(self, pbegin):
+        if isinstance(self._process_fn, beam.DoFn):
+            parse = beam.ParDo(self._process_fn, *self._args)
+        else:
+            parse = beam.Map(self._process_fn, *self._args)
+        return pbegin | \
+            'Read' >> beam.io.ReadFromText(self._file_pattern, coder=beam.coders.BytesCoder()) | \
+            'Parse' >> parse
+
+
+def join_artist_credit(element, artists) -> Iterable[Tuple[int, ArtistCreditRow]]:
+    """
+    Inner joins an artist_credit_name element with the artists side input. Artists are small enough to be
+    broadcast to every worker, so the large artist_credit_name PCollection is streamed instead of shuffled.
+    :param element: set(artist_id, artist_credit) produced by process_artist_credit
+    :param artists: dictionary of artist id to ArtistRow
+    :return: list with set(artist_credit, ArtistCreditRow), empty if the artist is unknown
+    """
+    artist_id, artist_credit = element
+    artist = artists.get(artist_id)
+    if artist is None:
+        return []
+    return [(artist_credit, ArtistCreditRow(*artist, artist_credit=artist_credit))]
+
+
+def salt_recording(element, shards) -> Tuple[Tuple[int, int], RecordingRow]:
+    """
+    Spreads recordings of one artist_credit over several join keys so a popular artist_credit is not merged by a
+    single worker
+    :param element: set(artist_credit, RecordingRow) produced by process_recording
+    :param shards: number of join keys every artist_credit is split into
+    :return: set((artist_credit, shard), RecordingRow)
+    """
+    artist_credit, recording = element
+    return ((artist_credit, zlib.crc32(recording.recording_gid.encode()) % shards), recording)
+
+
+def replicate_artist_credit(element, shards) -> Iterable[Tuple[Tuple[int, int], ArtistCreditRow]]:
+    """
+    Copies an artist credit to every shard produced by salt_recording so each shard can be joined on its own
+    :param element: set(artist_credit, ArtistCreditRow) produced by join_artist_credit
+    :param shards: number of join keys every artist_credit is split into
+    :return: list of set((artist_credit, shard), ArtistCreditRow), one per shard
+    """
+    artist_credit, row = element
+    return [((artist_credit, shard), row) for shard in range(shards)]
+
+
+def tag_artist_credit(element) -> Tuple[Any, JoinValue]:
+    """
+    Wraps an artist credit into the JoinValue shuffled by the recording join. Both join sides share this single
+    schema type so the GroupByKey encodes them with RowCoder instead of pickling a union of two types
+    :param element: set(key, ArtistCreditRow)
+    :return: set(key, JoinValue) with only artist_credit set
+    """
+    key, row = element
+    return (key, JoinValue(artist_credit=row, recording=None))
+
+
+def tag_recording(element) -> Tuple[Any, JoinValue]:
+    """
+    Wraps a recording into the JoinValue shuffled by the recording join
+    :param element: set(key, RecordingRow)
+    :return: set(key, JoinValue) with only recording set
+    """
+    key, row = element
+    return (key, JoinValue(artist_credit=None, recording=row))
 
 
 class UnSetCoGroup(beam.DoFn):
-    def process(self, element, source, joined, exclude_join_field):
+    def process(self, element, source, joined):
         """
         This method finalizes inner join. element is in the following form
-        (key, {source:[some dict elements], joined: [some dict elements]}). In order to perform the full
-        left join we need to combine columns from source with columns from joined.
-        In a nutshell we are doing a cartesian product
-        :param element: set containing id and the dictionary object
-        :param source: key for source array in the dictionary object
-        :param joined: key for joined array in the dictionary object
-        :param exclude_join_field: Field that should be excluded from objects in joined array when merging with
-        objects from source array
-        :return: joined dictionary
+        (key, [JoinValue, ...]) where every JoinValue has either its source or its joined field set. In order to
+        perform the full left join we need to combine columns from source with columns from joined.
+        In a nutshell we are doing a cartesian product. The grouped values are iterated twice: the first pass keeps
+        only the source side, which is small per key, and the second pass streams the joined side. The joined side
+        is never collected into a list, so the runner can page a large group from shuffle instead of holding it in
+        memory
+        :param element: set containing the key and the grouped JoinValue elements
+        :param source: JoinValue field holding the source side
+        :param joined: JoinValue field holding the joined side
+        :return: one merged dictionary per (source, joined) pair, with the columns of both named tuples
         """
-        _, grouped_dict = element
-        sources = grouped_dict[source]
-        joins = grouped_dict[joined]
-        for src in sources:
-            for join in joins:
-                for k, v in join.items():
-                    if k != exclude_join_field:
-                        src[k] = v
-                yield src
+        _, values = element
+        src_dicts = [getattr(value, source)._asdict() for value in values if getattr(value, source) is not None]
+        if not src_dicts:
+            return
+        for value in values:
+            join = getattr(value, joined)
+            if join is None:
+                continue
+            join_dict = join._asdict()
+            for src_dict in src_dicts:
+                yield {**src_dict, **join_dict}
 
 
 def main():
@@ -118,7 +257,17 @@ def main():
         default='recordings_by_artists_dataflow',
         help='BiqQuery table'
     )
+    parser.add_argument(
+        '--join_shards',
+        type=int,
+        default=1,
+        help='Number of shards every artist_credit is split into when joining recordings. Values above 1 '
+             'spread popular artist credits over several workers at the cost of copying every artist credit '
+             'to each shard'
+    )
     args, argv = parser.parse_known_args()
+    if args.join_shards < 1:
+        parser.error('--join_shards must be at least 1')
 
     pipeline_options = PipelineOptions(argv)
     pipeline_options.view_as(StandardOptions).runner = 'DataflowRunner'
@@ -128,6 +277,19 @@ def main():
     worker_options = pipeline_options.view_as(WorkerOptions)
     if not worker_options.use_public_ips:
         worker_options.use_public_ips = False
+    if not worker_options.machine_type:
+        worker_options.machine_type = 'n2-standard-16'
+    setup_options = pipeline_options.view_as(SetupOptions)
+    if not setup_options.requirements_file:
+        setup_options.requirements_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       'worker_requirements.txt')
+    debug_options = pipeline_options.view_as(DebugOptions)
+    if not debug_options.lookup_experiment('disable_runner_v2'):
+        debug_options.add_experiment('use_runner_v2')
+    if not debug_options.lookup_experiment('shuffle_mode'):
+        debug_options.add_experiment('shuffle_mode=service')
+    if not debug_options.number_of_worker_harness_threads:
+        debug_options.number_of_worker_harness_threads = 16
 
     table_spec = bigquery.TableReference(projectId=gcp_options.project,
                                          datasetId=args.dataset,
@@ -147,27 +309,21 @@ def main():
         ]
     }
 
-    with beam.Pipeline(options=pipeline_options) as pipeline:
-        gender = pipeline | \
-                 'Read gender' >> beam.io.ReadFromText('gs://solutions-public-assets/bqetl/gender.json') | \
-                 'Process gender' >> beam.Map(process_gender_or_area)
-
-        area = pipeline | \
-               'Read area' >> beam.io.ReadFromText('gs://solutions-public-assets/bqetl/area.json') | \
-               'Process area' >> beam.Map(process_gender_or_area)
+    gender_map = load_gender_or_area('gs://solutions-public-assets/bqetl/gender.json')
+    area_map = load_gender_or_area('gs://solutions-public-assets/bqetl/area.json')
 
+    with beam.Pipeline(options=pipeline_options) as pipeline:
         artists = pipeline | \
-                  'Read Artists' >> beam.io.ReadFromText('gs://solutions-public-assets/bqetl/artist.json') | \
-                  'Convert artist from json to dict' >> beam.Map(lambda e: json.loads(e)) | \
-                  'Process artists' >> beam.Map(process_artists, AsList(gender), AsList(area))
+                  'Read Artists' >> ReadJson('gs://solutions-public-assets/bqetl/artist.json',
+                                             ProcessArtists(gender_map, area_map))
 
         recordings = pipeline | \
-                     'Read Recordings' >> beam.io.ReadFromText('gs://solutions-public-assets/bqetl/recording.json') | \
-                     'Process recording' >> beam.Map(process_recording)
+                     'Read Recordings' >> ReadJson('gs://solutions-public-assets/bqetl/recording.json',
+                                                   process_recording)
 
         artist_credit_name = pipeline | \
-                             'Read Artists Credit Name' >> beam.io.ReadFromText('gs://solutions-public-assets/bqetl/artist_credit_name.json') | \
-                             'Process artist credit name' >> beam.Map(process_artist_credit)
+                             'Read Artists Credit Name' >> ReadJson('gs://solutions-public-assets/bqetl/artist_credit_name.json',
+                                                                    process_artist_credit)
 
         # Joining artist and artist_credit_name
         # SELECT artist.id,
@@ -179,15 +335,8 @@ def main():
         #  INNER JOIN datafusion-dataproc-tutorial.musicbrainz.artist_credit_name AS artist_credit_name
         #       ON artist.id = artist_credit_name.artist
         #
-        joined_artist_and_artist_credit_name = ({
-            'artists': artists,
-            'artist_credit_name': artist_credit_name}) | \
-            'Merge artist and artist_credit_name to intermitent' >> beam.CoGroupByKey() | \
-            'UnSetCoGroup intermitent' >> beam.ParDo(UnSetCoGroup(),
-                                                     'artists',
-                                                     'artist_credit_name',
-                                                     'artist') | \
-            'Map artist_credit to dict element' >> beam.Map(lambda e: (e['artist_credit'], e))
+        joined_artist_and_artist_credit_name = artist_credit_name | \
+            'Join artist_credit_name with artists' >> beam.FlatMap(join_artist_credit, AsDict(artists))
 
         # Joining previous table with recordings
         # SELECT intermitent.id,
@@ -202,16 +351,29 @@ def main():
         #  INNER JOIN datafusion-dataproc-tutorial.musicbrainz.recording AS recording
         #       ON intermitent.artist_credit = recording.artist_credit
         #
-        joined_artist_and_artist_credit_name_and_recording = ({
-            'joined_artist_and_artist_credit_name': joined_artist_and_artist_credit_name,
-            'recordings': recordings}) | \
-            'Merge intermitent and recording' >> beam.CoGroupByKey() | \
+        if args.join_shards > 1:
+            joined_artist_and_artist_credit_name = joined_artist_and_artist_credit_name | \
+                'Replicate intermitent to join shards' >> beam.FlatMap(replicate_artist_credit, args.join_shards)
+            recordings = recordings | \
+                'Salt recordings' >> beam.Map(salt_recording, args.join_shards)
+
+        tagged_artist_and_artist_credit_name = joined_artist_and_artist_credit_name | \
+            'Tag intermitent' >> beam.Map(tag_artist_credit)
+
+        tagged_recordings = recordings | \
+            'Tag recordings' >> beam.Map(tag_recording)
+
+        joined_artist_and_artist_credit_name_and_recording = \
+            (tagged_artist_and_artist_credit_name, tagged_recordings) | \
+            'Flatten intermitent and recording' >> beam.Flatten() | \
+            'Merge intermitent and recording' >> beam.GroupByKey() | \
             'UnSetCoGroup final' >> beam.ParDo(UnSetCoGroup(),
-                                               'joined_artist_and_artist_credit_name',
-                                               'recordings',
-                                               'artist_credit') | \
+                                               'artist_credit',
+                                               'recording') | \
             'Write To BQ' >> beam.io.WriteToBigQuery(table_spec,
                                                      schema=table_schema,
+                                                     method=beam.io.WriteToBigQuery.Method.FILE_LOADS,
+                                                     temp_file_format=FileFormat.AVRO,
                                                      write_disposition=beam.io.BigQueryDisposition.WRITE_TRUNCATE,
                                                      create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED)
 